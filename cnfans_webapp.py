@@ -1,17 +1,129 @@
+import asyncio
+import html
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
 import cloudscraper
-from bs4 import BeautifulSoup
+import lxml.html
+import numpy as np
+from lxml import etree
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import re
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 BASE_URL = "https://cnfans.com"
+SEARCH_URL = BASE_URL + "/search?keywords={keyword}&searchType=keywords"
+EXCHANGE_RATES_URL = "https://api.exchangerate.host/latest?base=CNY&symbols=USD,EUR"
+# Default headers for every CNFans request, set once on the shared scraper session
+SCRAPER_HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
+    ),
+    "Accept-Language": "en-US,en;q=0.9",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Referer": BASE_URL,
+    "Connection": "keep-alive",
+}
+DETAIL_FETCH_CONCURRENCY = 16
+# (connect, read) seconds: give up on unreachable hosts quickly, but allow slow pages to finish
+REQUEST_TIMEOUT = (2, 10)
+# Only transient gateway statuses are retried inside urllib3; connect and read timeouts fail
+# straight away so REQUEST_TIMEOUT stays the worst case per request. The final response is still
+# returned so raise_for_status() reports it. 503 is left out for CNFans because cloudscraper
+# answers Cloudflare's 503 challenge pages itself.
+SCRAPER_RETRY = Retry(total=2, connect=0, read=0, backoff_factor=0.2, status_forcelist=(502, 504),
+                      raise_on_status=False)
+HTTP_RETRY = Retry(total=2, connect=0, read=0, backoff_factor=0.2, status_forcelist=(502, 503, 504),
+                   raise_on_status=False)
+
+def _xpath_class(class_name: str) -> str:
+    """XPath predicate matching one whitespace-separated class token, like CSS .class"""
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')"
+
+# Product container selectors in priority order; the first one that matches wins
+PRODUCT_SELECTORS = [
+    ("li", "product-item"),
+    ("div", "product-list-item"),
+    ("div", "search-item"),
+    ("div", "item"),
+]
+PRODUCT_XPATHS = [etree.XPath(f"//{tag}[{_xpath_class(cls)}]") for tag, cls in PRODUCT_SELECTORS]
+
+def _xpath_text(path: str) -> etree.XPath:
+    """Compile an XPath returning the whitespace-normalized text of the first match as a plain str"""
+    return etree.XPath(f"normalize-space(({path})[1])", smart_strings=False)
+
+# Per-product field lookups, compiled once; each is a single libxml2 call returning a str
+# ("" when nothing matches). Title and price are tried in priority order.
+TITLE_XPATHS = [
+    _xpath_text(f".//a[{_xpath_class('product-title')}]"),
+    _xpath_text(".//h3"),
+    _xpath_text(".//a"),
+]
+PRICE_XPATHS = [
+    _xpath_text(f".//span[{_xpath_class('price')}]"),
+    _xpath_text(f".//div[{_xpath_class('price')}]"),
+    _xpath_text(f".//em[{_xpath_class('price')}]"),
+    _xpath_text(".//span"),
+]
+LINK_XPATH = _xpath_text(".//a/@href")
+IMG_XPATH = _xpath_text(".//img/@src")
+
+# First number in a price, as a capture group for Series.str.extract
+PRICE_RE = re.compile(r"([\d.]+)")
+# Strips the currency sign and thousands separators from price text in one pass
+PRICE_STRIP_TABLE = str.maketrans("", "", "¥,")
+# Full Google Sheet URLs with spreadsheet ID and optional path/query, matched on the raw HTML bytes
+SHEET_RE = re.compile(
+    rb"https?://docs\.google\.com/spreadsheets/d/[\w-]+(?:/[^\s'\")<>]+)?",
+    flags=re.IGNORECASE
+)
+
+_scraper_local = threading.local()
+
+def get_scraper() -> cloudscraper.CloudScraper:
+    """
+    Per-thread cloudscraper session. CloudScraper keeps its Cloudflare challenge state on the
+    instance without locking, so concurrent requests must not share one. Run CNFans requests
+    on get_scraper_pool() so each long-lived worker reuses its session's keep-alive connections.
+    """
+    scraper = getattr(_scraper_local, "scraper", None)
+    if scraper is None:
+        scraper = cloudscraper.create_scraper()
+        scraper.headers.update(SCRAPER_HEADERS)
+        # Set on cloudscraper's own HTTPS adapter, which carries the TLS cipher setup
+        scraper.get_adapter("https://").max_retries = SCRAPER_RETRY
+        _scraper_local.scraper = scraper
+    return scraper
+
+@st.cache_resource(show_spinner=False)
+def get_scraper_pool() -> ThreadPoolExecutor:
+    """Worker threads for CNFans requests, kept across reruns so their scrapers stay warm"""
+    return ThreadPoolExecutor(max_workers=DETAIL_FETCH_CONCURRENCY, thread_name_prefix="cnfans")
+
+def scraper_get(url: str) -> requests.Response:
+    """GET a CNFans URL with the calling thread's scraper"""
+    return get_scraper().get(url, timeout=REQUEST_TIMEOUT)
+
+@st.cache_resource(show_spinner=False)
+def get_http_session() -> requests.Session:
+    """Shared plain requests session for non-CNFans APIs"""
+    session = requests.Session()
+    session.headers.update({"Accept-Encoding": "gzip, deflate, br"})
+    session.mount("https://", HTTPAdapter(max_retries=HTTP_RETRY))
+    return session
 
 @st.cache_data(ttl=3600, show_spinner=False)
 def get_exchange_rates():
-    url = "https://api.exchangerate.host/latest?base=CNY&symbols=USD,EUR"
     try:
-        response = requests.get(url, timeout=10)
+        response = get_http_session().get(EXCHANGE_RATES_URL, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
         data = response.json()
         rates = data.get("rates", {})
@@ -22,167 +134,163 @@ def get_exchange_rates():
     except Exception:
         return {"EUR": None, "USD": None}
 
-@st.cache_data(ttl=3600, show_spinner=False)
-def fetch_product_page(url: str) -> BeautifulSoup | None:
-    """Fetch product detail page and return BeautifulSoup object"""
-    scraper = cloudscraper.create_scraper()
-    headers = {
-        "User-Agent": (
-            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-            "(KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
-        ),
-        "Accept-Language": "en-US,en;q=0.9",
-        "Connection": "keep-alive",
-    }
-    try:
-        response = scraper.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        return BeautifulSoup(response.text, "html.parser")
-    except Exception as e:
-        st.warning(f"Failed to fetch product page {url}: {e}")
-        return None
-
-def find_spreadsheet_links(soup: BeautifulSoup) -> list[str]:
+def fetch_product_page(url: str) -> bytes:
+    """Fetch product detail page and return its undecoded HTML (raises on network errors)"""
+    response = scraper_get(url)
+    response.raise_for_status()
+    return response.content
+
+# Persisted to disk so lookups are shared across keywords and survive restarts; only the
+# small list of URLs is stored, not the page HTML.
+# Streamlit ignores ttl for persisted caches, so max_entries is the only bound.
+@st.cache_data(show_spinner=False, persist="disk", max_entries=10_000)
+def find_spreadsheet_links(url: str) -> list[str]:
     """
-    Search the product page content for all Google Sheets URLs or other spreadsheet links,
+    Search a product page's raw HTML bytes for all Google Sheets URLs or other spreadsheet links,
     including those with category/parameter parts.
-    Returns a list of unique spreadsheet URLs found.
+    One regex pass covers both <a href> attributes and URLs in the page text.
+    Returns a list of unique spreadsheet URLs found (raises on network errors).
     """
-    spreadsheet_links = set()
-
-    # Regex to capture full Google Sheet URLs with spreadsheet ID and optional path/query
-    url_pattern = re.compile(
-        r"https?://docs\.google\.com/spreadsheets/d/[\w-]+(?:/[^\s'\")>]+)?",
-        flags=re.IGNORECASE
-    )
-
-    # Search all hrefs in <a> tags
-    for a_tag in soup.find_all("a", href=True):
-        href = a_tag["href"]
-        matches = url_pattern.findall(href)
-        for url in matches:
-            spreadsheet_links.add(url)
-
-    # Also search the raw text of the page for spreadsheet URLs
-    matches_in_text = url_pattern.findall(soup.get_text())
-    for url in matches_in_text:
-        spreadsheet_links.add(url)
-
-    return list(spreadsheet_links)
-
-@st.cache_data(show_spinner=False)
-def search_cnfans(keyword: str, max_price: float | None = None, max_results: int = 20):
-    exchange_rates = get_exchange_rates()
-    cny_to_eur = exchange_rates["EUR"] if exchange_rates["EUR"] else 0.13
-    cny_to_usd = exchange_rates["USD"] if exchange_rates["USD"] else 0.14
+    page_html = fetch_product_page(url)
+    return list({html.unescape(match.decode("utf-8", "replace")) for match in SHEET_RE.findall(page_html)})
 
-    keyword_encoded = requests.utils.quote(keyword)
-    search_url = f"{BASE_URL}/search?keywords={keyword_encoded}&searchType=keywords"
-
-    headers = {
-        "User-Agent": (
-            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-            "(KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
-        ),
-        "Accept-Language": "en-US,en;q=0.9",
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8",
-        "Referer": BASE_URL,
-        "Connection": "keep-alive",
-    }
-
-    scraper = cloudscraper.create_scraper()
+async def _find_all_spreadsheet_links(urls: list[str]) -> list[list[str] | Exception]:
+    """
+    Look up spreadsheet links for several product pages concurrently on the scraper pool,
+    at most DETAIL_FETCH_CONCURRENCY at a time. Failed fetches are returned as exceptions.
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_scraper_pool()
+    lookups = (loop.run_in_executor(pool, find_spreadsheet_links, url) for url in urls)
+    return await asyncio.gather(*lookups, return_exceptions=True)
+
+def first_text(node, xpaths: list[etree.XPath]) -> str:
+    """Return the first non-empty text produced by the XPaths in priority order, or an empty string"""
+    for xpath in xpaths:
+        text = xpath(node)
+        if text:
+            return text
+    return ""
+
+# Bounded so distinct keywords cannot grow the cache without limit; prices refresh every 10 minutes
+@st.cache_data(ttl=600, max_entries=128, show_spinner=False)
+def _fetch_raw(keyword: str) -> pd.DataFrame:
+    """
+    Fetch and parse the CNFans search page for a keyword.
+    Returns every product found with its CNY price, link and image URL, unfiltered,
+    so that changing max_price or max_results never repeats the network request.
+    """
+    search_url = SEARCH_URL.format(keyword=requests.utils.quote(keyword))
 
     try:
-        response = scraper.get(search_url, headers=headers, timeout=10)
+        response = get_scraper_pool().submit(scraper_get, search_url).result()
         response.raise_for_status()
     except Exception as e:
         st.error(f"Network error: {e}")
-        return []
-
-    soup = BeautifulSoup(response.text, "html.parser")
+        return pd.DataFrame()
 
-    product_selectors = [
-        ("li", "product-item"),
-        ("div", "product-list-item"),
-        ("div", "search-item"),
-        ("div", "item"),
-    ]
+    # Hand libxml2 the raw bytes with the response charset; it decodes in C, skipping response.text
+    try:
+        try:
+            parser = lxml.html.HTMLParser(encoding=response.encoding)
+        except LookupError:
+            # Charset label lxml doesn't know (e.g. utf-8mb4): let libxml2 detect it from the page
+            parser = lxml.html.HTMLParser()
+        tree = lxml.html.fromstring(response.content, parser=parser)
+    except etree.ParserError:
+        tree = None
 
     products = []
-    for tag, class_name in product_selectors:
-        found = soup.find_all(tag, class_=class_name)
-        if found:
-            products = found
-            break
+    if tree is not None:
+        for products_xpath in PRODUCT_XPATHS:
+            found = products_xpath(tree)
+            if found:
+                products = found
+                break
 
     if not products:
         st.warning("Could not find product elements with current selectors. Site structure may have changed.")
-        return []
+        return pd.DataFrame()
 
-    results = []
-    count = 0
+    titles, price_texts, links, img_urls = [], [], [], []
 
     for product in products:
-        if count >= max_results:
-            break
-
-        try:
-            title_tag = product.find("a", class_="product-title") or product.find("h3") or product.find("a")
-            if not title_tag:
-                continue
-
-            title = title_tag.get_text(strip=True)
-
-            price_tag = product.find("span", class_="price") or product.find("div", class_="price") or product.find("em", class_="price") or product.find("span")
-            if not price_tag:
-                continue
-
-            price_text = price_tag.get_text(strip=True).replace("¥", "").replace(",", "")
-            price_numbers = re.findall(r"[\d.]+", price_text)
-            if not price_numbers:
-                continue
-            price_cny = float(price_numbers[0])
-
-            if max_price is not None and price_cny > max_price:
-                continue
-
-            link_tag = product.find("a", href=True)
-            if not link_tag:
-                continue
-
-            link = link_tag["href"]
-            if link.startswith("/"):
-                link = BASE_URL + link
-
-            img_tag = product.find("img")
-            img_url = None
-            if img_tag and img_tag.has_attr("src"):
-                img_url = img_tag["src"]
-                if img_url.startswith("/"):
-                    img_url = BASE_URL + img_url
-
-            # Fetch product page to find spreadsheet links
-            product_soup = fetch_product_page(link)
-            spreadsheet_links = find_spreadsheet_links(product_soup) if product_soup else []
-
-            price_eur = round(price_cny * cny_to_eur, 2)
-            price_usd = round(price_cny * cny_to_usd, 2)
-
-            results.append({
-                "Title": title,
-                "Price (¥)": price_cny,
-                "Price (€)": price_eur,
-                "Price ($)": price_usd,
-                "Link": link,
-                "ImgURL": img_url,
-                "Spreadsheet Links": spreadsheet_links,
-            })
-            count += 1
-        except Exception as e:
-            st.write(f"Skipped one product due to parsing error: {e}")
+        title = first_text(product, TITLE_XPATHS)
+        link = LINK_XPATH(product)
+        if not title or not link:
             continue
 
-    return results
+        if link.startswith("/"):
+            link = BASE_URL + link
+
+        img_url = IMG_XPATH(product) or None
+        if img_url and img_url.startswith("/"):
+            img_url = BASE_URL + img_url
+
+        titles.append(title)
+        price_texts.append(first_text(product, PRICE_XPATHS))
+        links.append(link)
+        img_urls.append(img_url)
+
+    # Parse every price in one vectorized pass; unparseable prices become NaN and are dropped
+    prices = pd.to_numeric(
+        pd.Series(price_texts, dtype=object).str.translate(PRICE_STRIP_TABLE).str.extract(PRICE_RE, expand=False),
+        errors="coerce",
+    ).to_numpy(dtype=np.float64)
+
+    df = pd.DataFrame({
+        "Title": titles,
+        "Price (¥)": prices,
+        "Link": links,
+        # object dtype keeps missing images as None rather than NaN under pandas' str dtype
+        "ImgURL": pd.Series(img_urls, dtype=object),
+    })
+    return df[~np.isnan(prices)].reset_index(drop=True)
+
+def search_cnfans(
+    keyword: str,
+    cny_to_eur: float,
+    cny_to_usd: float,
+    max_price: float | None = None,
+    max_results: int = 20,
+) -> pd.DataFrame:
+    raw = _fetch_raw(keyword)
+    if raw.empty:
+        return raw
+
+    if max_price is not None:
+        raw = raw[raw["Price (¥)"].to_numpy() <= max_price]
+    raw = raw.head(max_results).reset_index(drop=True)
+    links = raw["Link"].tolist()
+
+    # Fetch product pages concurrently to find spreadsheet links
+    lookups = asyncio.run(_find_all_spreadsheet_links(links))
+    spreadsheet_links = []
+    for link, lookup in zip(links, lookups):
+        if isinstance(lookup, Exception):
+            st.warning(f"Failed to fetch product page {link}: {lookup}")
+            spreadsheet_links.append([])
+        else:
+            spreadsheet_links.append(lookup)
+
+    prices_cny = raw["Price (¥)"].to_numpy(dtype=np.float64)
+    return pd.DataFrame({
+        "Title": raw["Title"],
+        "Price (¥)": prices_cny,
+        "Price (€)": np.round(prices_cny * cny_to_eur, 2),
+        "Price ($)": np.round(prices_cny * cny_to_usd, 2),
+        "Link": raw["Link"],
+        "ImgURL": raw["ImgURL"],
+        "Spreadsheet Links": spreadsheet_links,
+    })
+
+def _df_to_csv(df: pd.DataFrame) -> bytes:
+    """Encode the flattened results (spreadsheet links joined into one string) as CSV bytes"""
+    # Select the exported columns during the Arrow conversion instead of copying via df.drop
+    columns = [column for column in df.columns if column != "ImgURL"]
+    csv_buffer = io.BytesIO()
+    pacsv.write_csv(pa.Table.from_pandas(df, columns=columns, preserve_index=False), csv_buffer)
+    return csv_buffer.getvalue()
 
 def main():
     st.set_page_config(page_title="CNFans.com Shop Scraper with Spreadsheets", layout="centered")
@@ -192,21 +300,18 @@ def main():
     max_price = st.number_input("Maximum price in CNY (¥)", min_value=0.0, step=1.0, format="%.2f")
     max_results = st.slider("Maximum number of results to display", 1, 20, 10)
 
+    # Resolve the rates once per run and pass them down, falling back to static rates
     exchange_rates = get_exchange_rates()
-    cny_to_eur = exchange_rates["EUR"]
-    cny_to_usd = exchange_rates["USD"]
+    live_rates = bool(exchange_rates["EUR"] and exchange_rates["USD"])
+    cny_to_eur = exchange_rates["EUR"] if exchange_rates["EUR"] else 0.13
+    cny_to_usd = exchange_rates["USD"] if exchange_rates["USD"] else 0.14
 
-    if max_price > 0 and cny_to_eur and cny_to_usd:
+    if max_price > 0:
         price_eur = round(max_price * cny_to_eur, 2)
         price_usd = round(max_price * cny_to_usd, 2)
         st.markdown(
             f"**Max Price Specified:** {max_price:.2f} CNY ≈ {price_eur:.2f} EUR ≈ {price_usd:.2f} USD"
-        )
-    elif max_price > 0:
-        price_eur = round(max_price * 0.13, 2)
-        price_usd = round(max_price * 0.14, 2)
-        st.markdown(
-            f"**Max Price Specified:** {max_price:.2f} CNY ≈ {price_eur:.2f} EUR ≈ {price_usd:.2f} USD (using static rates)"
+            + ("" if live_rates else " (using static rates)")
         )
 
     if st.button("Search"):
@@ -215,15 +320,21 @@ def main():
             return
 
         with st.spinner("🔎 Searching CNFans.com and scanning for spreadsheets... (this may take some seconds)"):
-            results = search_cnfans(keyword, max_price=max_price if max_price > 0 else None, max_results=max_results)
-
-        if not results:
+            results = search_cnfans(
+                keyword,
+                cny_to_eur,
+                cny_to_usd,
+                max_price=max_price if max_price > 0 else None,
+                max_results=max_results,
+            )
+
+        if results.empty:
             st.info("No products found matching the criteria.")
             return
 
         st.markdown("### Search Results")
 
-        for item in results:
+        for item in results.to_dict("records"):
             cols = st.columns([1, 5])
             if item["ImgURL"]:
                 with cols[0]:
@@ -243,9 +354,8 @@ def main():
                     st.write("*No spreadsheet links found*")
 
         # Prepare dataframe for CSV export -- flatten spreadsheet list to comma-separated string
-        df = pd.DataFrame(results)
-        df["Spreadsheet Links"] = df["Spreadsheet Links"].apply(lambda links: ", ".join(links) if links else "")
-        df_csv = df.drop(columns=["ImgURL"]).to_csv(index=False).encode("utf-8")
+        df = results.assign(**{"Spreadsheet Links": results["Spreadsheet Links"].str.join(", ")})
+        df_csv = _df_to_csv(df)
         st.download_button(
             label="Download results as CSV",
             data=df_csv,